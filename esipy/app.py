@@ -1,10 +1,16 @@
 # -*- encoding: utf-8 -*-
 """ App entry point. Uses Esi Meta Endpoint to work """
+import functools
+import hashlib
 import time
 
 import logging
-import requests
+from collections import namedtuple
 from urllib.error import HTTPError
+from weakref import WeakValueDictionary
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
 
 from openapi_core import OpenAPI
 
@@ -12,30 +18,54 @@ from .utils import check_cache
 from .utils import get_cache_time_left
 from .exceptions import APIException
 
+# both accept bytes directly, no need to decode the body first
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # pragma: no cover
+    from json import loads as _json_loads
+
 LOGGER = logging.getLogger(__name__)
 
+# wrappers still in use, indexed by (spec content hash, url) so identical
+# specs share the same wrapper
+_OPENAPI_REGISTRY = WeakValueDictionary()
+
+# shared session so spec fetches reuse keep-alive connections, server
+# errors are retried with an exponential backoff
+_SESSION = requests.Session()
+_SESSION_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(500, 502, 503, 504),
+    )
+)
+_SESSION.mount('http://', _SESSION_ADAPTER)
+_SESSION.mount('https://', _SESSION_ADAPTER)
+
+
+class _SafeDict(dict):
+    """ dict for str.format_map that leaves missing placeholders as is """
+
+    def __missing__(self, key):
+        return '{' + key + '}'
+
 
 class OperationProxy:
     """Proxy object to make OpenAPI operations compatible with pyswagger interface"""
     
-    def __init__(self, operation_id, openapi_wrapper):
+    def __init__(self, operation_id, openapi_wrapper, path, method):
         self.operation_id = operation_id
         self.openapi_wrapper = openapi_wrapper
-        self.url = self._extract_url()
-    
-    def _extract_url(self):
-        """Extract URL from the OpenAPI spec for this operation"""
-        spec = self.openapi_wrapper.spec
-        for path, methods in spec.get('paths', {}).items():
-            for method, operation in methods.items():
-                if operation.get('operationId') == self.operation_id:
-                    # Return the path template
-                    return path
-        return None
+        self.url = path
+        self.method = method
+        self.api_url = openapi_wrapper.api_url
     
     def __call__(self, **kwargs):
         """Create a request object compatible with EsiClient"""
-        return OperationRequest(self.operation_id, self.openapi_wrapper, **kwargs)
+        return OperationRequest(MockRequest(self, **kwargs), MockResponse())
 
 
 class MockResponse:
@@ -64,22 +94,27 @@ class MockResponse:
         if raw is not None:
             self.raw = raw
             if not self.raw_body_only:
-                import json
                 try:
-                    self.data = json.loads(raw.decode('utf-8'))
-                except (json.JSONDecodeError, UnicodeDecodeError):
+                    self.data = _json_loads(raw)
+                except ValueError:
+                    # JSONDecodeError and UnicodeDecodeError
                     self.data = raw
 
 
 class MockRequest:
     """Mock request object compatible with pyswagger interface"""
     
-    def __init__(self, operation_id, openapi_wrapper, **params):
-        self.operation_id = operation_id
-        self.openapi_wrapper = openapi_wrapper
+    def __init__(self, operation_proxy, **params):
+        self.operation_id = operation_proxy.operation_id
+        self.openapi_wrapper = operation_proxy.openapi_wrapper
         self.params = params
-        self.url = self._build_url()
-        self.method = self._get_method()
+        self.method = operation_proxy.method
+
+        # path templates ("/characters/{character_id}/") are valid format
+        # strings, replace path parameters, keep the placeholder if not given
+        self.url = operation_proxy.api_url + operation_proxy.url.format_map(
+            _SafeDict(params)
+        )
         self._p = self._build_params()
         self.query = {}
         self.header = {}
@@ -97,38 +132,6 @@ class MockRequest:
         """Patch request with options - compatibility method"""
         pass
     
-    def _get_method(self):
-        """Get HTTP method for this operation"""
-        spec = self.openapi_wrapper.spec
-        for path, methods in spec.get('paths', {}).items():
-            for method, operation in methods.items():
-                if operation.get('operationId') == self.operation_id:
-                    return method.upper()
-        return 'GET'
-    
-    def _build_url(self):
-        """Build the URL for this request"""
-        spec = self.openapi_wrapper.spec
-        
-        # Extract the base URL from the OpenAPI spec
-        servers = spec.get('servers', [])
-        if servers:
-            base_url = servers[0].get('url', 'https://esi.evetech.net')
-        else:
-            base_url = 'https://esi.evetech.net'
-        
-        base_url = base_url.rstrip('/')
-        
-        for path, methods in spec.get('paths', {}).items():
-            for method, operation in methods.items():
-                if operation.get('operationId') == self.operation_id:
-                    # Replace path parameters
-                    url_path = path
-                    for param_name, param_value in self.params.items():
-                        url_path = url_path.replace(f'{{{param_name}}}', str(param_value))
-                    return base_url + url_path
-        return base_url
-    
     def _build_params(self):
         """Build parameters dict compatible with EsiClient"""
         return {
@@ -138,25 +141,8 @@ class MockRequest:
         }
 
 
-class OperationRequest:
-    """Request object compatible with EsiClient - returns tuple of (request, response)"""
-    
-    def __init__(self, operation_id, openapi_wrapper, **params):
-        self.request = MockRequest(operation_id, openapi_wrapper, **params)
-        self.response = MockResponse()
-    
-    def __iter__(self):
-        """Make this object act like a tuple (request, response)"""
-        return iter([self.request, self.response])
-    
-    def __getitem__(self, index):
-        """Allow indexing like req_and_resp[0] and req_and_resp[1]"""
-        if index == 0:
-            return self.request
-        elif index == 1:
-            return self.response
-        else:
-            raise IndexError("Index out of range")
+# request object compatible with EsiClient, a (request, response) tuple
+OperationRequest = namedtuple('OperationRequest', ['request', 'response'])
 
 
 class OperationsCollection:
@@ -165,16 +151,27 @@ class OperationsCollection:
     def __init__(self, openapi_wrapper):
         self.openapi_wrapper = openapi_wrapper
         self._operations = {}
+        self.urls = []
+        self.swagger_ops = set()
         self._build_operations()
     
     def _build_operations(self):
-        """Build operation proxies from OpenAPI spec"""
-        spec = self.openapi_wrapper.spec
-        for path, methods in spec.get('paths', {}).items():
-            for method, operation in methods.items():
-                operation_id = operation.get('operationId')
-                if operation_id:
-                    self._operations[operation_id] = OperationProxy(operation_id, self.openapi_wrapper)
+        """Build operation proxies from the operation index, in one pass"""
+        self._operations = {
+            operation_id: OperationProxy(
+                operation_id, self.openapi_wrapper, path, method
+            )
+            for operation_id, (path, method, _)
+            in self.openapi_wrapper.op_index.items()
+        }
+        self.urls = [proxy.url for proxy in self._operations.values()]
+
+        # operations returning a swagger spec, used by EsiApp.__getattr__
+        self.swagger_ops = {
+            operation_id
+            for operation_id, proxy in self._operations.items()
+            if proxy.url and 'swagger.json' in proxy.url
+        }
     
     def __getitem__(self, key):
         return self._operations[key]
@@ -198,7 +195,52 @@ class OpenAPIWrapper:
     def __init__(self, spec, base_url):
         self.spec = spec
         self.base_url = base_url
-        self.openapi = OpenAPI.from_dict(spec)
+
+        # index operations once: {operationId: (path, METHOD, operation)}
+        self.op_index = {
+            operation['operationId']: (path, method.upper(), operation)
+            for path, methods in spec.get('paths', {}).items()
+            for method, operation in methods.items()
+            if operation.get('operationId')
+        }
+
+        # the servers block never changes, compute the API root only once
+        servers = spec.get('servers') or [{}]
+        self.api_url = (
+            servers[0].get('url') or 'https://esi.evetech.net'
+        ).rstrip('/')
+
+        self.op = OperationsCollection(self)
+
+    @classmethod
+    def from_content(cls, content, base_url):
+        """ Return the wrapper for the raw spec content, reusing the one
+        built for an identical spec if it is still alive """
+        key = (hashlib.sha1(content).hexdigest(), base_url)
+        app = _OPENAPI_REGISTRY.get(key)
+        if app is None:
+            app = cls(_json_loads(content), base_url)
+            _OPENAPI_REGISTRY[key] = app
+        return app
+
+    @functools.cached_property
+    def openapi(self):
+        """ The openapi-core object. Validating and compiling the spec is
+        the most expensive step, so it is only built on first access """
+        return OpenAPI.from_dict(self.spec)
+
+    def __getstate__(self):
+        """ Only pickle the spec and the precomputed data """
+        return {
+            'spec': self.spec,
+            'base_url': self.base_url,
+            'op_index': self.op_index,
+            'api_url': self.api_url,
+        }
+
+    def __setstate__(self, state):
+        """ Restore the wrapper, the openapi object is built lazily """
+        self.__dict__.update(state)
         self.op = OperationsCollection(self)
 
 
@@ -206,6 +248,17 @@ class EsiApp(object):
     """ EsiApp is an app object that'll allows us to play with ESI Meta
     API, not to have to deal with all ESI versions manually / meta """
 
+    __slots__ = (
+        '_app',
+        'meta_url',
+        'expire',
+        'cache_prefix',
+        'esi_meta_cache_key',
+        'caching',
+        'cache',
+        'datasource',
+    )
+
     def __init__(self, **kwargs):
         """ Constructor.
 
@@ -227,25 +280,71 @@ class EsiApp(object):
             self.expire = 86400
 
         self.cache_prefix = kwargs.pop('cache_prefix', 'esipy')
-        self.esi_meta_cache_key = '%s:app:meta_swagger_url' % self.cache_prefix
+        self.esi_meta_cache_key = f'{self.cache_prefix}:app:meta_swagger_url'
 
         cache = kwargs.pop('cache', False)
         self.caching = True if cache is not None else False
         self.cache = check_cache(cache)
         self.datasource = kwargs.pop('datasource', 'tranquility')
 
+        self._app = None
         self.app = self.__get_or_create_app(
             self.meta_url,
             self.esi_meta_cache_key
         )
 
+    @classmethod
+    def get(cls, **kwargs):
+        """ Return a shared EsiApp for these parameters, only building it
+        on the first call. Takes the same parameters as the constructor.
+
+        Use EsiApp() directly if you need distinct instances.
+        """
+        return cls._cached(
+            kwargs.pop('meta_url', 'https://esi.evetech.net/swagger.json'),
+            kwargs.pop('datasource', 'tranquility'),
+            kwargs.pop('cache_prefix', 'esipy'),
+            kwargs.pop('cache_time', 86400),
+            kwargs.pop('cache', False)
+        )
+
+    @classmethod
+    @functools.lru_cache(maxsize=16)
+    def _cached(cls, meta_url, datasource, cache_prefix, expire, cache):
+        """ Memoized constructor used by EsiApp.get(). BaseCache instances
+        hash by identity, so the cache object is part of the key """
+        return cls(
+            meta_url=meta_url,
+            datasource=datasource,
+            cache_prefix=cache_prefix,
+            cache_time=expire,
+            cache=cache
+        )
+
+    @property
+    def app(self):
+        """ The meta app. If it is None, create it again from cache / by
+        querying ESI """
+        if self._app is None:
+            self._app = self.__get_or_create_app(
+                self.meta_url,
+                self.esi_meta_cache_key
+            )
+        return self._app
+
+    @app.setter
+    def app(self, value):
+        self._app = value
+
     def __get_or_create_app(self, url, cache_key):
         """ Get the app from cache or generate a new one if required
 
-        Because app object doesn't have etag/expiry, we have to make
-        a head() call before, to have these informations first... """
+        Because app object doesn't have etag/expiry, we store the response
+        headers along with it, and use them to make a conditional request
+        so a single call either validates the cached app or gets the new
+        spec... """
         headers = {"Accept": "application/json"}
-        app_url = '%s?datasource=%s' % (url, self.datasource)
+        app_url = f'{url}?datasource={self.datasource}'
 
         cached = self.cache.get(cache_key, (None, None, 0))
         if cached is None or len(cached) != 3:
@@ -270,14 +369,19 @@ class EsiApp(object):
                 if self.expire == 0 or cached_expiry >= time.time():
                     return cached_app
 
-            # if we have etags, add the header to use them
+            # if we have etags / last-modified, use them to validate the
+            # cached app instead of downloading the spec again
             etag = cached_headers.get('etag', None)
             if etag is not None:
                 headers['If-None-Match'] = etag
+            last_modified = cached_headers.get('last-modified', None)
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
 
             # if nothing makes us use the cache, invalidate it
             if ((expires is None or cache_timeout < 0 or
-                 cached_expiry < time.time()) and etag is None):
+                 cached_expiry < time.time()) and
+                    etag is None and last_modified is None):
                 self.cache.invalidate(cache_key)
 
         # set timeout value in case we have to cache it later
@@ -285,43 +389,31 @@ class EsiApp(object):
         if self.expire is not None and self.expire > 0:
             timeout = time.time() + self.expire
 
-        # we are here, we know we have to make a head call...
-        res = requests.head(app_url, headers=headers)
-        if self.expire is not None and self.expire > 0:
-            expiration = self.expire
-        else:
-            expiration = get_cache_time_left(
-                res.headers.get('expires')
-            )
-        if res.status_code == 304 and cached_app is not None:
-            self.cache.set(
-                cache_key,
-                (cached_app, res.headers, timeout),
-                expiration
-            )
-            return cached_app
-
-        # ok, cache is not accurate, make the full stuff
-        # also retry up to 3 times if we get any errors
+        # we are here, we know we have to make a conditional request
+        # errors are retried by the session adapter
         app = None
-        for _retry in range(1, 4):
-            try:
-                # Download the OpenAPI spec
-                spec_response = requests.get(app_url)
-                spec_response.raise_for_status()
-                
-                # Create OpenAPI instance from the spec
-                openapi_spec = spec_response.json()
-                app = OpenAPIWrapper(openapi_spec, app_url)
-            except (HTTPError, requests.RequestException) as error:
-                LOGGER.warning(
-                    "[failure #%d] %s: %r",
-                    _retry,
-                    app_url,
-                    str(error)
-                )
-                continue
-            break
+        try:
+            # stream the body so it is read once, as bytes, and the
+            # connection is released as soon as we leave the block
+            with _SESSION.get(app_url, headers=headers, stream=True) as res:
+                if res.status_code == 304 and cached_app is not None:
+                    # cached app is still up to date
+                    app = cached_app
+                elif res.status_code == 200:
+                    # Create OpenAPI instance from the spec
+                    app = OpenAPIWrapper.from_content(
+                        res.content,
+                        app_url
+                    )
+                else:
+                    res.raise_for_status()
+                    LOGGER.warning(
+                        "[failure] %s: unexpected status %d",
+                        app_url,
+                        res.status_code
+                    )
+        except (HTTPError, ValueError, requests.RequestException) as error:
+            LOGGER.warning("[failure] %s: %r", app_url, str(error))
 
         if app is None:
             raise APIException(
@@ -330,6 +422,13 @@ class EsiApp(object):
                 response="Cannot fetch '%s'." % app_url
             )
 
+        if self.expire is not None and self.expire > 0:
+            expiration = self.expire
+        else:
+            expiration = get_cache_time_left(
+                res.headers.get('expires')
+            )
+
         if self.caching and app:
             self.cache.set(cache_key, (app, res.headers, timeout), expiration)
 
@@ -345,30 +444,17 @@ class EsiApp(object):
         if name == 'op':
             return self.app.op
 
-        try:
-            op_attr = self.app.op[name]
-        except KeyError:
+        operations = self.app.op
+        if name not in operations.swagger_ops:
+            if name in operations:
+                raise AttributeError('%s is not a swagger endpoint' % name)
             raise AttributeError('%s is not a valid operation' % name)
 
-        # if the endpoint is a swagger spec
-        if 'swagger.json' in op_attr.url:
-            spec_url = 'https:%s' % op_attr.url
-            cache_key = '%s:app:%s' % (self.cache_prefix, op_attr.url)
-            return self.__get_or_create_app(spec_url, cache_key)
-        else:
-            raise AttributeError('%s is not a swagger endpoint' % name)
-
-    def __getattribute__(self, name):
-        """ Get attribute. If attribute is app, and app is None, create it
-        again from cache / by querying ESI """
-        attr = super(EsiApp, self).__getattribute__(name)
-        if name == 'app' and attr is None:
-            attr = self.__get_or_create_app(
-                self.meta_url,
-                self.esi_meta_cache_key
-            )
-            self.app = attr
-        return attr
+        # the endpoint is a swagger spec
+        op_attr = operations[name]
+        spec_url = f'{operations.openapi_wrapper.api_url}{op_attr.url}'
+        cache_key = f'{self.cache_prefix}:app:{op_attr.url}'
+        return self.__get_or_create_app(spec_url, cache_key)
 
     def clear_cached_endpoints(self, prefix=None):
         """ Invalidate all cached endpoints, meta included
@@ -380,8 +466,9 @@ class EsiApp(object):
         :param: prefix the prefix for the cache key (default is cache_prefix)
         """
         prefix = prefix if prefix is not None else self.cache_prefix
-        for endpoint in self.app.op.values():
-            cache_key = '%s:app:%s' % (prefix, endpoint.url)
-            self.cache.invalidate(cache_key)
-        self.cache.invalidate('%s:app:meta_swagger_url' % self.cache_prefix)
-        self.app = None
+        cache_keys = [
+            f'{prefix}:app:{url}' for url in self.app.op.urls
+        ]
+        cache_keys.append(f'{self.cache_prefix}:app:meta_swagger_url')
+        self.cache.invalidate_many(cache_keys)
+        self._app = None
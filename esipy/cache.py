@@ -35,6 +35,12 @@ class BaseCache(object):
         """ Invalidate a cache key """
         raise NotImplementedError
 
+    def invalidate_many(self, keys):
+        """ Invalidate multiple cache keys. Backends able to do it in a
+        single call should override this. """
+        for key in keys:
+            self.invalidate(key)
+
 
 class FileCache(BaseCache):
     """ BaseCache implementation using files to store the data.
@@ -136,6 +142,9 @@ class MemcachedCache(BaseCache):
     def invalidate(self, key):
         return self._mc.delete(_hash(key))
 
+    def invalidate_many(self, keys):
+        return self._mc.delete_multi([_hash(key) for key in keys])
+
 
 class RedisCache(BaseCache):
     """ BaseCache implementation for Redis cache.
@@ -166,3 +175,8 @@ class RedisCache(BaseCache):
 
     def invalidate(self, key):
         return self._r.delete(_hash(key))
+
+    def invalidate_many(self, keys):
+        if not keys:
+            return 0
+        return self._r.delete(*[_hash(key) for key in keys])
@@ -13,6 +13,12 @@ install_requirements = [
     "python-jose >= 3.0 , < 4"
 ]
 
+# optional requirements
+extras_requirements = {
+    # faster json parsing for specs and responses
+    "fast": ["orjson"],
+}
+
 # test requirements
 test_requirements = [
     "coverage",
@@ -38,6 +44,7 @@ setup(
     description='Swagger Client for the ESI API for EVE Online',
     long_description=README,
     install_requires=install_requirements,
+    extras_require=extras_requirements,
     tests_require=test_requirements,
     test_suite='nose.collector',
     classifiers=[
@@ -1,16 +1,26 @@
 # -*- encoding: utf-8 -*-
 # pylint: skip-file
 from esipy import EsiApp
+from esipy.app import MockResponse
+from esipy.app import OpenAPIWrapper
 from esipy.cache import DictCache
+from esipy.cache import FileCache
 from esipy.exceptions import APIException
-from pyswagger import App
 
+import gc
 import httmock
 import mock
+import pickle
+import shutil
+import threading
 import unittest
-from urllib.error import HTTPError
+import weakref
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
 
 from .mock import _swagger_spec_mock_
+from .mock import meta_swagger
+from .mock import v1_swagger
 from .mock import make_expire_time_str
 from .mock import make_expired_time_str
 
@@ -20,10 +30,39 @@ pyswagger_logger = logging.getLogger('pyswagger')
 pyswagger_logger.setLevel(logging.ERROR)
 
 
+def _serve_meta_spec(statuses):
+    """ Start a local HTTP server, answering each request with the next
+    status from statuses (the last one is repeated). 200 serves the meta
+    spec. httmock replaces Session.send, which would skip the transport
+    adapter retries, so a real server is required here. """
+    served = []
+
+    class MetaSpecHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status = statuses[min(len(served), len(statuses) - 1)]
+            served.append(self.path)
+            body = b''
+            if status == 200:
+                with open(TestEsiApp.ESI_META_SWAGGER, 'rb') as spec:
+                    body = spec.read()
+            self.send_response(status)
+            self.send_header('Expires', make_expire_time_str())
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), MetaSpecHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, served
+
+
 class TestEsiApp(unittest.TestCase):
 
     ESI_CACHE_PREFIX = 'esipy_test'
-    ESI_V1_CACHE_KEY = '%s:app://esi.evetech.net/v1/swagger.json' % (
+    ESI_V1_CACHE_KEY = '%s:app:/v1/swagger.json' % (
         ESI_CACHE_PREFIX
     )
     ESI_META_SWAGGER = 'test/resources/meta_swagger.json'
@@ -39,22 +78,192 @@ class TestEsiApp(unittest.TestCase):
     @mock.patch('urllib.request.urlopen')
     def test_app_op_attribute(self, urlopen_mock):
         self.assertTrue(self.app.op)
-        self.assertEqual(
-            self.app.op['verify'].url,
-            '//esi.evetech.net/verify/'
-        )
+        self.assertEqual(self.app.op['get_verify'].url, '/verify/')
 
         urlopen_mock.return_value = open(TestEsiApp.ESI_META_SWAGGER)
         with httmock.HTTMock(*_swagger_spec_mock_):
             app = EsiApp(cache_prefix='esipy_test', cache_time=-1)
             self.assertEqual(app.expire, 86400)
 
+    def test_app_pickle(self):
+        app = pickle.loads(pickle.dumps(self.app.app))
+        self.assertEqual(app.spec, self.app.app.spec)
+        self.assertEqual(
+            sorted(app.op.keys()),
+            sorted(self.app.op.keys())
+        )
+        self.assertEqual(app.op['get_verify'].url, '/verify/')
+        self.assertIsNotNone(app.openapi)
+
+    def test_app_file_cache(self):
+        @httmock.all_requests
+        def fail_if_request(url, request):
+            self.fail('Cached app is not supposed to do requests')
+
+        shutil.rmtree('tmp', ignore_errors=True)
+        cache = FileCache('tmp')
+        with httmock.HTTMock(*_swagger_spec_mock_):
+            app = EsiApp(cache_prefix='esipy_test', cache=cache)
+
+        # new cache object on the same path, as a new process would do
+        cache = FileCache('tmp')
+        cached_app = cache.get(app.esi_meta_cache_key)[0]
+        self.assertIsInstance(cached_app, OpenAPIWrapper)
+        self.assertIsNot(cached_app, app.app)
+        self.assertEqual(
+            sorted(cached_app.op.keys()),
+            sorted(app.op.keys())
+        )
+
+        with httmock.HTTMock(fail_if_request):
+            esiapp = EsiApp(cache_prefix='esipy_test', cache=cache)
+            self.assertEqual(esiapp.op['get_verify'].url, '/verify/')
+        shutil.rmtree('tmp', ignore_errors=True)
+
+    @mock.patch('urllib.request.urlopen')
+    def test_app_get_shared(self, urlopen_mock):
+        EsiApp._cached.cache_clear()
+        urlopen_mock.return_value = open(TestEsiApp.ESI_META_SWAGGER)
+        cache = DictCache()
+        with httmock.HTTMock(*_swagger_spec_mock_):
+            app = EsiApp.get(cache_prefix='esipy_test', cache=cache)
+            self.assertIs(
+                app,
+                EsiApp.get(cache_prefix='esipy_test', cache=cache)
+            )
+            self.assertIs(app.cache, cache)
+
+            urlopen_mock.return_value = open(TestEsiApp.ESI_META_SWAGGER)
+            self.assertIsNot(
+                app,
+                EsiApp.get(cache_prefix='esipy_test', cache=DictCache())
+            )
+        EsiApp._cached.cache_clear()
+
+    def test_app_get_releases_cache(self):
+        EsiApp._cached.cache_clear()
+        cache = DictCache()
+        cache_ref = weakref.ref(cache)
+        with httmock.HTTMock(*_swagger_spec_mock_):
+            EsiApp.get(cache_prefix='esipy_test', cache=cache)
+            del cache
+
+            # evict the first instance from the lru
+            for _ in range(EsiApp._cached.cache_info().maxsize):
+                EsiApp.get(cache_prefix='esipy_test', cache=DictCache())
+
+        gc.collect()
+        self.assertIsNone(cache_ref())
+        EsiApp._cached.cache_clear()
+
+    def _v1_operation(self, operation_id):
+        with open(TestEsiApp.ESI_V1_SWAGGER, 'rb') as spec:
+            app = OpenAPIWrapper.from_content(
+                spec.read(),
+                'https://esi.evetech.net/v1/swagger.json'
+            )
+        return app.op[operation_id]
+
+    def test_app_operation_request_url(self):
+        operation = self._v1_operation('get_characters_character_id_location')
+
+        req = operation(character_id=5)[0]
+        self.assertEqual(
+            req.url,
+            'https://esi.evetech.net/characters/5/location/'
+        )
+        self.assertEqual(req.method, 'GET')
+
+        # missing path parameters keep their placeholder
+        req = operation()[0]
+        self.assertEqual(
+            req.url,
+            'https://esi.evetech.net/characters/{character_id}/location/'
+        )
+
+        # unknown parameters are ignored in the url
+        req = operation(character_id=5, foo='bar')[0]
+        self.assertEqual(
+            req.url,
+            'https://esi.evetech.net/characters/5/location/'
+        )
+
+    def test_app_operation_request_tuple(self):
+        operation = self._v1_operation('get_characters_character_id_location')
+
+        req_and_resp = operation(character_id=5)
+        req, resp = req_and_resp
+        self.assertIs(req_and_resp[0], req)
+        self.assertIs(req_and_resp[1], resp)
+        self.assertIs(req_and_resp.request, req)
+        self.assertIs(req_and_resp.response, resp)
+        self.assertIsInstance(resp, MockResponse)
+        self.assertEqual(
+            req.url,
+            'https://esi.evetech.net/characters/5/location/'
+        )
+
+    def test_app_mock_response_apply_with(self):
+        response = MockResponse()
+        response.apply_with(status=200, header={}, raw=b'[1, 2]')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.data, [1, 2])
+
+        # invalid utf-8 and non json bodies fall back to the raw body
+        for raw in (b'\xff', b'<html>'):
+            response = MockResponse()
+            response.apply_with(raw=raw)
+            self.assertEqual(response.raw, raw)
+            self.assertEqual(response.data, raw)
+
+        response = MockResponse()
+        response.raw_body_only = True
+        response.apply_with(raw=b'[1, 2]')
+        self.assertEqual(response.raw, b'[1, 2]')
+        self.assertIsNone(response.data)
+
+    def test_app_api_url(self):
+        spec = {
+            'openapi': '3.0.0',
+            'info': {'title': 'esipy', 'version': '1'},
+            'paths': {},
+        }
+        app = OpenAPIWrapper(spec, 'https://esi.evetech.net/swagger.json')
+        self.assertEqual(app.api_url, 'https://esi.evetech.net')
+
+        spec['servers'] = []
+        app = OpenAPIWrapper(spec, 'https://esi.evetech.net/swagger.json')
+        self.assertEqual(app.api_url, 'https://esi.evetech.net')
+
+        spec['servers'] = [{'url': 'https://esi.example.com/latest/'}]
+        app = OpenAPIWrapper(spec, 'https://esi.evetech.net/swagger.json')
+        self.assertEqual(app.api_url, 'https://esi.example.com/latest')
+
+    def test_app_from_content(self):
+        with open(TestEsiApp.ESI_V1_SWAGGER, 'rb') as spec:
+            content = spec.read()
+        url = 'https://esi.evetech.net/v1/swagger.json'
+
+        app = OpenAPIWrapper.from_content(content, url)
+        self.assertIs(app, OpenAPIWrapper.from_content(content, url))
+        self.assertIsNot(
+            app,
+            OpenAPIWrapper.from_content(content, url + '?datasource=tq')
+        )
+
+    def test_app_openapi_lazy(self):
+        app = pickle.loads(pickle.dumps(self.app.app))
+        self.assertNotIn('openapi', app.__dict__)
+        openapi = app.openapi
+        self.assertIsNotNone(openapi)
+        self.assertIs(app.openapi, openapi)
+
     def test_app_getattr_fail(self):
         with self.assertRaises(AttributeError):
             self.app.doesnotexist
 
         with self.assertRaises(AttributeError):
-            self.app.verify
+            self.app.get_verify
 
     @mock.patch('urllib.request.urlopen')
     def test_app_invalid_cache_value(self, urlopen_mock):
@@ -79,7 +288,7 @@ class TestEsiApp(unittest.TestCase):
             self.assertEqual(len(self.app.cache._dict), 1)
             appv1 = self.app.get_v1_swagger
 
-            self.assertTrue(isinstance(appv1, App))
+            self.assertTrue(isinstance(appv1, OpenAPIWrapper))
             self.assertEqual(
                 self.app.cache.get(self.ESI_V1_CACHE_KEY)[0],
                 appv1
@@ -112,7 +321,7 @@ class TestEsiApp(unittest.TestCase):
             )
             appv1 = app_nocache.get_v1_swagger
 
-            self.assertTrue(isinstance(appv1, App))
+            self.assertTrue(isinstance(appv1, OpenAPIWrapper))
             self.assertIsNone(
                 app_nocache.cache.get(self.ESI_V1_CACHE_KEY, None))
 
@@ -150,21 +359,90 @@ class TestEsiApp(unittest.TestCase):
             self.assertEqual(cached_app, esiapp.app)
             urlopen_mock.return_value.close()
 
-    @mock.patch('urllib.request.urlopen')
-    def test_app_expired_header_no_etag(self, urlopen_mock):
+    def test_app_expired_header_last_modified(self):
+        last_modified = make_expired_time_str()
+        revalidations = []
+
+        @httmock.all_requests
+        def spec_last_modified(url, request):
+            with open(TestEsiApp.ESI_META_SWAGGER) as swagger_json:
+                return httmock.response(
+                    headers={
+                        'Expires': make_expire_time_str(),
+                        'Last-Modified': last_modified
+                    },
+                    status_code=200,
+                    content=swagger_json.read()
+                )
+
+        @httmock.all_requests
+        def check_last_modified(url, request):
+            revalidations.append(request)
+            self.assertEqual(
+                request.headers.get('If-Modified-Since'),
+                last_modified
+            )
+            self.assertIsNone(request.headers.get('If-None-Match'))
+            return httmock.response(
+                headers={
+                    'Expires': make_expire_time_str(),
+                    'Last-Modified': last_modified
+                },
+                status_code=304)
+
         cache = DictCache()
-        with httmock.HTTMock(*_swagger_spec_mock_):
-            urlopen_mock.return_value = open(TestEsiApp.ESI_META_SWAGGER)
+        with httmock.HTTMock(spec_last_modified):
             app = EsiApp(
                 cache_time=None, cache=cache, cache_prefix='esipy_test')
 
-            urlopen_mock.return_value = open(TestEsiApp.ESI_V1_SWAGGER)
-            appv1 = app.get_v1_swagger
-            cache.get(self.ESI_V1_CACHE_KEY)[1]['Expires'] = None
+        cache.get(
+            app.esi_meta_cache_key
+        )[1]['expires'] = make_expired_time_str()
+        cached_app = cache.get(app.esi_meta_cache_key)[0]
 
-            urlopen_mock.return_value = open(TestEsiApp.ESI_V1_SWAGGER)
-            appv1_uncached = app.get_v1_swagger
-            self.assertNotEqual(appv1, appv1_uncached)
+        with httmock.HTTMock(check_last_modified):
+            esiapp = EsiApp(
+                cache_time=None, cache=cache, cache_prefix='esipy_test')
+            self.assertIs(cached_app, esiapp.app)
+
+        self.assertEqual(len(revalidations), 1)
+        # cached app must not have been invalidated, only refreshed
+        self.assertIs(cache.get(app.esi_meta_cache_key)[0], cached_app)
+
+    def test_app_expired_header_no_etag(self):
+        v1_requests = []
+
+        @httmock.urlmatch(
+            scheme="https",
+            netloc=r"esi\.evetech\.net$",
+            path=r"^/v1/swagger.json$"
+        )
+        def count_v1_swagger(url, request):
+            v1_requests.append(request)
+            return v1_swagger(url, request)
+
+        cache = DictCache()
+        v1_url = 'https://esi.evetech.net/v1/swagger.json?datasource=tranquility'
+        with httmock.HTTMock(meta_swagger, count_v1_swagger):
+            app = EsiApp(
+                cache_time=None, cache=cache, cache_prefix='esipy_test')
+
+            with mock.patch.object(
+                    OpenAPIWrapper,
+                    'from_content',
+                    wraps=OpenAPIWrapper.from_content) as from_content:
+                appv1 = app.get_v1_swagger
+                self.assertEqual(len(v1_requests), 1)
+                self.assertEqual(from_content.call_count, 1)
+                self.assertEqual(from_content.call_args[0][1], v1_url)
+
+                cache.get(self.ESI_V1_CACHE_KEY)[1]['Expires'] = None
+                appv1_uncached = app.get_v1_swagger
+
+                # spec is fetched again, but is identical so wrapper is reused
+                self.assertEqual(len(v1_requests), 2)
+                self.assertEqual(from_content.call_count, 2)
+                self.assertIs(appv1, appv1_uncached)
 
     @mock.patch('urllib.request.urlopen')
     def test_app_valid_header_etag(self, urlopen_mock):
@@ -183,39 +461,59 @@ class TestEsiApp(unittest.TestCase):
             EsiApp(cache_time=None, cache=cache, cache_prefix='esipy_test')
             urlopen_mock.return_value.close()
 
-    @mock.patch('urllib.request.urlopen')
-    def test_app_http_error_retry_fail(self, urlopen_mock):
-        urlopen_mock.side_effect = HTTPError(
-            "http://mock.test",
-            500,
-            "HTTP 500 whatever",
-            None,
-            None
-        )
-        with httmock.HTTMock(*_swagger_spec_mock_):
+    def test_app_invalid_json(self):
+        @httmock.all_requests
+        def html_body(url, request):
+            return httmock.response(
+                status_code=200,
+                content='<html>oops</html>'
+            )
+
+        with httmock.HTTMock(html_body):
             with self.assertRaises(APIException):
-                self.app = EsiApp(cache_prefix='esipy_test')
-            self.assertEqual(urlopen_mock.call_count, 3)
+                EsiApp(cache_prefix='esipy_test')
 
-    @mock.patch('urllib.request.urlopen')
-    def test_app_http_error_retry_ok(self, urlopen_mock):
-        http_error = HTTPError(
-            "http://mock.test",
-            500,
-            "HTTP 500 whatever",
-            None,
-            None
-        )
+    def test_app_not_modified_without_cache(self):
+        @httmock.all_requests
+        def not_modified(url, request):
+            return httmock.response(
+                headers={'Expires': make_expire_time_str()},
+                status_code=304
+            )
 
-        # this will make the function raise exception / return the value
-        # in this given order
-        side_effect_results = [
-            http_error,
-            http_error,
-            open(TestEsiApp.ESI_META_SWAGGER)
-        ]
+        with httmock.HTTMock(not_modified):
+            with self.assertRaises(APIException):
+                EsiApp(cache_prefix='esipy_test')
 
-        urlopen_mock.side_effect = side_effect_results
-        with httmock.HTTMock(*_swagger_spec_mock_):
-            EsiApp(cache_prefix='esipy_test')
-            self.assertEqual(urlopen_mock.call_count, 3)
+    def test_app_http_error_retry_fail(self):
+        server, served = _serve_meta_spec([500])
+        try:
+            with self.assertRaises(APIException):
+                EsiApp(
+                    cache_prefix='esipy_test',
+                    meta_url='http://127.0.0.1:%d/swagger.json' % (
+                        server.server_port
+                    )
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # first call + 3 retries
+        self.assertEqual(len(served), 4)
+
+    def test_app_http_error_retry_ok(self):
+        server, served = _serve_meta_spec([500, 503, 200])
+        try:
+            app = EsiApp(
+                cache_prefix='esipy_test',
+                meta_url='http://127.0.0.1:%d/swagger.json' % (
+                    server.server_port
+                )
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(len(served), 3)
+        self.assertIn('get_verify', app.op)
@@ -66,6 +66,13 @@ class TestBaseCache(BaseTest):
     def test_base_cache_invalidate(self):
         self.assertRaises(NotImplementedError, self.c.invalidate, 'key')
 
+    def test_base_cache_invalidate_many(self):
+        self.assertRaises(
+            NotImplementedError,
+            self.c.invalidate_many,
+            ['key']
+        )
+
 
 class TestDictCache(BaseTest):
     """ DictCache test class """
@@ -93,6 +100,12 @@ class TestDictCache(BaseTest):
         self.c.invalidate(self.ex_cpx[0])
         self.assertIsNone(self.c.get(self.ex_cpx[0]))
 
+    def test_dict_cache_invalidate_many(self):
+        self.c.invalidate_many([self.ex_str[0], self.ex_cpx[0]])
+        self.assertIsNone(self.c.get(self.ex_str[0]))
+        self.assertIsNone(self.c.get(self.ex_cpx[0]))
+        self.assertEqual(self.c.get(self.ex_int[0]), self.ex_int[1])
+
     def test_dict_cache_clear(self):
         self.assertEqual(self.c._dict[self.ex_str[0]], self.ex_str[1])
         self.assertEqual(len(self.c._dict), 3)
@@ -213,6 +226,13 @@ class TestMemcachedCache(BaseTest):
         self.c.invalidate(self.ex_str[0])
         self.assertEqual(self.c.get(self.ex_str[0]), None)
 
+    def test_memcached_invalidate_many(self):
+        self.c.set(*self.ex_str)
+        self.c.set(*self.ex_int)
+        self.c.invalidate_many([self.ex_str[0], self.ex_int[0]])
+        self.assertEqual(self.c.get(self.ex_str[0]), None)
+        self.assertEqual(self.c.get(self.ex_int[0]), None)
+
     def test_memcached_invalid_argument(self):
         with self.assertRaises(TypeError):
             MemcachedCache(None)
@@ -273,6 +293,14 @@ class TestRedisCache(BaseTest):
         self.c.invalidate(self.ex_str[0])
         self.assertEqual(self.c.get(self.ex_str[0]), None)
 
+    def test_redis_invalidate_many(self):
+        self.c.set(*self.ex_str)
+        self.c.set(*self.ex_int)
+        self.c.invalidate_many([self.ex_str[0], self.ex_int[0]])
+        self.assertEqual(self.c.get(self.ex_str[0]), None)
+        self.assertEqual(self.c.get(self.ex_int[0]), None)
+        self.c.invalidate_many([])
+
     def test_redis_invalid_argument(self):
         with self.assertRaises(TypeError):
             RedisCache(None)